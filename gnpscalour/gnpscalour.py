@@ -2,11 +2,16 @@ import webbrowser
 from logging import getLogger, basicConfig, NOTSET
 from logging.config import fileConfig
 from pkg_resources import resource_filename
-from collections import defaultdict
 
 import numpy as np
 import pandas as pd
 
+try:
+    # optional - used to parallelize the mz/rt matching if installed
+    import numba
+except ImportError:
+    numba = None
+
 from calour.database import Database
 
 __version__ = '2020.07.12'
@@ -14,23 +19,75 @@ __version_numeric__ = 2020.0712
 
 logger = getLogger(__name__)
 
-try:
-    # get the logger config file location
-    log = resource_filename(__name__, 'log.cfg')
-    # set the logger output according to log.cfg
-    # setting False allows other logger to print log.
-    fileConfig(log, disable_existing_loggers=False)
-    # set the log level to same value as calour log level
-    clog = getLogger('calour')
-    calour_log_level = clog.getEffectiveLevel()
-    if calour_log_level != NOTSET:
-        logger.setLevel(calour_log_level)
-except:
-    print('FAILED loading logging config file %s' % log)
-    basicConfig(format='%(levelname)s:%(message)s')
+_logging_configured = False
+
+
+def configure_logging():
+    '''Set up the gnpscalour logger from the packaged log.cfg file.
+
+    Idempotent - the configuration is only applied on the first call, so
+    repeated imports (e.g. in worker processes or notebooks) don't redo the
+    config file parsing.
+    '''
+    global _logging_configured
+    if _logging_configured:
+        return
+    try:
+        # get the logger config file location
+        log = resource_filename(__name__, 'log.cfg')
+        # set the logger output according to log.cfg
+        # setting False allows other logger to print log.
+        fileConfig(log, disable_existing_loggers=False)
+        # set the log level to same value as calour log level
+        clog = getLogger('calour')
+        calour_log_level = clog.getEffectiveLevel()
+        if calour_log_level != NOTSET:
+            logger.setLevel(calour_log_level)
+    except:
+        print('FAILED loading logging config file %s' % log)
+        basicConfig(format='%(levelname)s:%(message)s')
+    _logging_configured = True
+
+
+configure_logging()
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _match_counts(fmz, frt, mz_sorted, mz_order, rt, mzerr, rterr, counts):
+        '''Count the gnps annotations within the mz/rt windows of each feature.'''
+        for i in numba.prange(len(fmz)):
+            lo = np.searchsorted(mz_sorted, fmz[i] - mzerr, side='left')
+            hi = np.searchsorted(mz_sorted, fmz[i] + mzerr, side='right')
+            num = 0
+            for k in range(lo, hi):
+                if abs(rt[mz_order[k]] - frt[i]) < rterr:
+                    num += 1
+            counts[i] = num
+
+    @numba.njit(parallel=True, cache=True)
+    def _match_fill(fmz, frt, mz_sorted, mz_order, rt, mzerr, rterr, out_offsets, out_indices):
+        '''Write the matching gnps annotation indices of each feature into the flat out_indices buffer.'''
+        for i in numba.prange(len(fmz)):
+            lo = np.searchsorted(mz_sorted, fmz[i] - mzerr, side='left')
+            hi = np.searchsorted(mz_sorted, fmz[i] + mzerr, side='right')
+            j = out_offsets[i]
+            for k in range(lo, hi):
+                cidx = mz_order[k]
+                if abs(rt[cidx] - frt[i]) < rterr:
+                    out_indices[j] = cidx
+                    j += 1
 
 
 class GNPS(Database):
+    # the cached arrays are accessed inside the per-feature loops, so keep them in
+    # slots for direct offset loads (the calour Database base class still has __dict__,
+    # so attributes it sets are unaffected)
+    __slots__ = ('gnps_data', 'mzfield', 'rtfield', 'exp', '_mz', '_rt',
+                 '_mz_order', '_mz_sorted', '_col_cache', '_isna_cache',
+                 '_gnps_offsets', '_gnps_indices', '_feat_idx',
+                 '_feat_mz', '_feat_rt', '_feature_terms_cache')
+
     def __init__(self, exp=None):
         super().__init__(exp=exp, database_name='GNPS', methods=['get'])
         # if 'gnpscalour' not in exp.databases:
@@ -42,12 +99,81 @@ class GNPS(Database):
         self.mzfield = 'parent mass'
         self.rtfield = 'RTMean'
         self.exp = exp
-        self.gnps_data[self.mzfield] = pd.to_numeric(self.gnps_data[self.mzfield], errors='coerce')
-        self.gnps_data[self.rtfield] = pd.to_numeric(self.gnps_data[self.rtfield], errors='coerce')
+        self.gnps_data[self.mzfield] = pd.to_numeric(self.gnps_data[self.mzfield], errors='coerce').fillna(0.0)
+        self.gnps_data[self.rtfield] = pd.to_numeric(self.gnps_data[self.rtfield], errors='coerce').fillna(0.0)
+        # cache the mz/rt columns as numpy arrays and keep a sorted mz index,
+        # so _find_close_annotation can do a binary search instead of scanning the whole table.
+        # float32 gives ~7 significant digits - plenty for the mz/rt match windows -
+        # at half the memory bandwidth of float64
+        self._mz = self.gnps_data[self.mzfield].to_numpy(np.float32)
+        self._rt = self.gnps_data[self.rtfield].to_numpy(np.float32)
+        self._mz_order = np.argsort(self._mz)
+        self._mz_sorted = self._mz[self._mz_order]
+        # lazy cache of gnps table columns as numpy arrays (column name -> array),
+        # to avoid per-row pandas .iloc lookups in the annotation queries
+        self._col_cache = {}
+        # lazy cache of per-column N/A masks, so get_feature_terms can filter N/A
+        # entries with a vectorized mask; precompute for LibraryID (the default term type)
+        self._isna_cache = {}
+        self._get_column_isna('LibraryID')
+        # feature -> gnps positions links, packed as a flat indices array with
+        # per-feature offsets (filled by _prepare_gnps_ids)
+        self._gnps_offsets = None
+        self._gnps_indices = None
+        self._feat_idx = None
+        self._feat_mz = None
+        self._feat_rt = None
+        # calour creates a fresh GNPS instance per database call, so reuse links
+        # prepared by a previous instance through the shared experiment info
+        links = exp.info.get('_calour_gnps_links')
+        if links is not None:
+            self._gnps_offsets = links['offsets']
+            self._gnps_indices = links['indices']
+            self._feat_idx = links['feat_idx']
+            self._feat_mz = links['feat_mz']
+            self._feat_rt = links['feat_rt']
+        # memoized get_feature_terms results (term_type -> feature -> terms)
+        self._feature_terms_cache = {}
 
     def version(self):
         return __version_numeric__
 
+    def _get_column(self, column):
+        '''Get a gnps table column as a numpy array (cached).
+
+        Parameters
+        ----------
+        column : str
+            name of the column in the gnps clusterinfo file
+
+        Returns
+        -------
+        numpy.ndarray
+            the column values, indexable by annotation position
+        '''
+        if column not in self._col_cache:
+            self._col_cache[column] = self.gnps_data[column].to_numpy()
+        return self._col_cache[column]
+
+    def _get_column_isna(self, column):
+        '''Get a boolean mask of the N/A entries in a gnps table column (cached).
+
+        Parameters
+        ----------
+        column : str
+            name of the column in the gnps clusterinfo file
+
+        Returns
+        -------
+        numpy.ndarray of bool
+            True where the column is the 'N/A' string or nan
+        '''
+        if column not in self._isna_cache:
+            values = self._get_column(column)
+            # pandas reads the N/A cells as nan, so mask both
+            self._isna_cache[column] = (values == 'N/A') | pd.isna(values)
+        return self._isna_cache[column]
+
     def _prepare_gnps_ids(self, direct_ids=False, mz_thresh=0.02, rt_thresh=15, use_gnps_id_from_AllFiles=True):
         '''Link each feature in the experiment to the corresponding gnps table id.
 
@@ -62,40 +188,103 @@ class GNPS(Database):
             (if direct_ids is True).
         '''
         logger.debug('Locating GNPS ids')
-        self.exp.feature_metadata['_gnps_ids'] = None
+        feature_ids = self.exp.feature_metadata.index.values
         # if we don't have the linked gnps table, all are NA
         if direct_ids:
             logger.debug('locating ids using direct_ids')
+            # an empty gnps table can't match any feature (and would break the
+            # vectorized parsing/search below), so raise the not-found error up front
+            if len(self.gnps_data.index) == 0 and len(feature_ids) > 0:
+                cmet = feature_ids[0]
+                logger.warning('metabolite %s not found in gnps file. Are you using correct ids?' % cmet)
+                raise ValueError('metabolite ID %s not found in gnps file. Are you using correct ids?' % cmet)
             # get the gnps ids values from the gnps file
             if use_gnps_id_from_AllFiles:
                 logger.debug('using AllFiles field')
-                gnps_metabolite_ids = []
-                for cid in self.gnps_data['AllFiles']:
-                    cid = cid.split(':')[-1]
-                    cid = cid.split('###')[0]
-                    cid = int(cid)
-                    gnps_metabolite_ids.append(cid)
+                # the id is the part after the last ':' and before the first '###'
+                gnps_metabolite_ids = self.gnps_data['AllFiles'].str.rsplit(':', n=1).str[-1].str.split('###').str[0].astype(np.int64).to_numpy()
             else:
                 logger.debug('using cluster index field')
-                gnps_metabolite_ids = self.gnps_data['cluster index'].astype(int)
-            gnps_metabolite_ids_pos = {}
-            for idx, cmet in enumerate(gnps_metabolite_ids):
-                gnps_metabolite_ids_pos[cmet] = idx
-            gnps_ids = {}
-            for cmet in self.exp.feature_metadata.index.values:
-                if int(cmet) in gnps_metabolite_ids_pos:
-                    gnps_ids[cmet] = [gnps_metabolite_ids_pos[int(cmet)]]
-                else:
-                    logger.warning('metabolite %s not found in gnps file. Are you using correct ids?' % cmet)
-                    raise ValueError('metabolite ID %s not found in gnps file. Are you using correct ids?' % cmet)
+                gnps_metabolite_ids = self.gnps_data['cluster index'].to_numpy(np.int64)
+            # match all features against the sorted gnps ids in one vectorized pass
+            feat_ids_int = np.asarray(feature_ids, dtype=np.int64)
+            id_order = np.argsort(gnps_metabolite_ids)
+            ids_sorted = gnps_metabolite_ids[id_order]
+            pos = np.searchsorted(ids_sorted, feat_ids_int)
+            pos = np.minimum(pos, len(ids_sorted) - 1)
+            not_found = np.flatnonzero(ids_sorted[pos] != feat_ids_int)
+            if len(not_found) > 0:
+                cmet = feature_ids[not_found[0]]
+                logger.warning('metabolite %s not found in gnps file. Are you using correct ids?' % cmet)
+                raise ValueError('metabolite ID %s not found in gnps file. Are you using correct ids?' % cmet)
+            # each feature links to exactly one gnps row
+            indices = id_order[pos]
+            offsets = np.arange(len(feature_ids) + 1, dtype=np.int64)
         else:
             # match using MZ/RT
             logger.debug('linking using MZ (thresh %f) and RT (thresh %f)' % (mz_thresh, rt_thresh))
-            gnps_ids = {}
-            for cmet in self.exp.feature_metadata.index.values:
-                cids = self._find_close_annotation(self.exp.feature_metadata['MZ'][cmet], self.exp.feature_metadata['RT'][cmet], mzerr=mz_thresh, rterr=rt_thresh)
-                gnps_ids[cmet] = cids
-        self.exp.feature_metadata['_gnps_ids'] = pd.Series(gnps_ids)
+            fmz = self.exp.feature_metadata['MZ'].to_numpy(np.float32)
+            frt = self.exp.feature_metadata['RT'].to_numpy(np.float32)
+            if numba is not None:
+                # count the matches per feature, then fill a flat index buffer - both kernels
+                # run in parallel over the features
+                counts = np.zeros(len(fmz), dtype=np.int64)
+                _match_counts(fmz, frt, self._mz_sorted, self._mz_order, self._rt, mz_thresh, rt_thresh, counts)
+                offsets = np.zeros(len(fmz) + 1, dtype=np.int64)
+                np.cumsum(counts, out=offsets[1:])
+                indices = np.empty(offsets[-1], dtype=np.int64)
+                _match_fill(fmz, frt, self._mz_sorted, self._mz_order, self._rt, mz_thresh, rt_thresh, offsets, indices)
+            else:
+                # find the mz windows for all features in two vectorized binary searches,
+                # then filter each (small) candidate slice by the rt window.
+                # the (few) feature mz values are searched in the (large) sorted annotation
+                # mz array; sorting the queries first keeps the binary searches cache friendly
+                forder = np.argsort(fmz)
+                fmz_sorted = fmz[forder]
+                lo = np.searchsorted(self._mz_sorted, fmz_sorted - mz_thresh, 'left')
+                hi = np.searchsorted(self._mz_sorted, fmz_sorted + mz_thresh, 'right')
+                hits = [None] * len(feature_ids)
+                for sidx in range(len(feature_ids)):
+                    idx = forder[sidx]
+                    cand = self._mz_order[lo[sidx]:hi[sidx]]
+                    hits[idx] = cand[np.abs(self._rt[cand] - frt[idx]) < rt_thresh]
+                offsets = np.zeros(len(feature_ids) + 1, dtype=np.int64)
+                np.cumsum([len(chits) for chits in hits], out=offsets[1:])
+                indices = np.concatenate(hits) if len(hits) > 0 else np.empty(0, dtype=np.int64)
+        # store as a packed structure-of-arrays: flat indices with per-feature offsets,
+        # and a feature label -> row dict for O(1) lookup
+        self._feat_idx = {cmet: idx for idx, cmet in enumerate(feature_ids)}
+        if not direct_ids:
+            # also keep the feature mz/rt arrays, so per-feature mz/rt lookups are
+            # a dict probe + array deref instead of two pandas label lookups
+            self._feat_mz = fmz
+            self._feat_rt = frt
+        self._gnps_offsets = offsets
+        self._gnps_indices = indices
+        # persist on the experiment (next to the gnps table itself), so the fresh
+        # GNPS instances calour creates for later database calls reuse the links
+        self.exp.info['_calour_gnps_links'] = {'offsets': offsets, 'indices': indices,
+                                               'feat_idx': self._feat_idx,
+                                               'feat_mz': self._feat_mz,
+                                               'feat_rt': self._feat_rt}
+        # the links changed, so the memoized per-feature terms are stale
+        self._feature_terms_cache = {}
+
+    def _feature_positions(self, feature):
+        '''Get the gnps table positions linked to a feature.
+
+        Parameters
+        ----------
+        feature : str
+            the feature id (from the experiment feature_metadata index)
+
+        Returns
+        -------
+        numpy.ndarray
+            row positions in the gnps table matching the feature
+        '''
+        idx = self._feat_idx[feature]
+        return self._gnps_indices[self._gnps_offsets[idx]:self._gnps_offsets[idx + 1]]
 
     def _prepare_gnps_names(self):
         '''Add the GNPS database name to each metabolite (if known) or 'na' if unknown.
@@ -131,17 +320,14 @@ class GNPS(Database):
         -------
         list of close annotation indices
         '''
-        try:
-            mz = float(mz)
-            rt = float(rt)
-            self.gnps_data.fillna(0, inplace=True)
-            mzpos = np.where(np.abs(self.gnps_data[self.mzfield].values - mz) < mzerr)[0]
-            rtpos = np.where(np.abs(self.gnps_data[self.rtfield] - rt) < rterr)[0]
-            pos = np.intersect1d(mzpos, rtpos)
-            return pos
-        except:
-            logger.warn('Cannot process GNPS for mz: %s, rt: %s' % (mz, rt))
-            return np.empty(0)
+        # match the cached arrays' dtype so the comparison stays in float32
+        mz = np.float32(mz)
+        rt = np.float32(rt)
+        # binary search the sorted mz array for the mz window, then check rt only on the candidates
+        lo = np.searchsorted(self._mz_sorted, mz - mzerr, 'left')
+        hi = np.searchsorted(self._mz_sorted, mz + mzerr, 'right')
+        cand = self._mz_order[lo:hi]
+        return cand[np.abs(self._rt[cand] - rt) < rterr]
 
     def get_seq_annotation_strings(self, feature):
         '''Get nice string summaries of annotations for a given sequence
@@ -165,14 +351,19 @@ class GNPS(Database):
         shortdesc = []
         if self.gnps_data is None:
             return []
-        # pos = self._find_close_annotation(self._exp.feature_metadata['MZ'][feature], self._exp.feature_metadata['RT'][feature])
-        pos = self._exp.feature_metadata['_gnps_ids'][feature]
+        # the linking parameters (direct_ids, thresholds) are the caller's choice,
+        # so fail clearly rather than silently re-linking with the defaults
+        if self._gnps_offsets is None:
+            raise ValueError('GNPS ids are not linked to the experiment features. Please call _prepare_gnps_ids() first.')
+        pos = self._feature_positions(feature)
         if len(pos) == 0:
             return []
+        links = self._get_column('ProteoSAFeClusterLink')
+        library_ids = self._get_column('LibraryID')
         for clabel in ['parent mass', 'RTMean', 'LibraryID', 'AllOrganisms', 'componentindex']:
-            shortdesc.append(({'annotationtype': 'other', 'feature': feature, 'gnps_link': self.gnps_data.iloc[pos[0]]['ProteoSAFeClusterLink']}, '%s: %s' % (clabel, self.gnps_data.iloc[pos[0]][clabel])))
+            shortdesc.append(({'annotationtype': 'other', 'feature': feature, 'gnps_link': links[pos[0]]}, '%s: %s' % (clabel, self._get_column(clabel)[pos[0]])))
         for cpos in pos:
-            shortdesc.append(({'annotationtype': 'other', 'feature': feature, 'gnps_link': self.gnps_data.iloc[cpos]['ProteoSAFeClusterLink']}, str(self.gnps_data.iloc[cpos]['LibraryID'])))
+            shortdesc.append(({'annotationtype': 'other', 'feature': feature, 'gnps_link': links[cpos]}, str(library_ids[cpos])))
         return shortdesc
 
     def show_annotation_info(self, annotation):
@@ -238,22 +429,22 @@ class GNPS(Database):
         '''
         if term_type not in self.gnps_data.columns:
             raise ValueError('term_type %s not a column in the gnps clusterinfo file.' % term_type)
-        feature_terms = defaultdict(list)
-        for cfeature in features:
-            # pos = self._find_close_annotation(self._exp.feature_metadata['MZ'][cfeature], self._exp.feature_metadata['RT'][cfeature])
-            pos = self._exp.feature_metadata['_gnps_ids'][cfeature]
-            cterms = {}
-            foundna = False
-            for cpos in pos:
-                cterm = self.gnps_data.iloc[cpos][term_type]
-                # pandas treats N/A as nan
-                # if cterm == 'N/A' or not isinstance(cterm, str):
-                if cterm == 'N/A':
-                    foundna = True
-                    continue
-                cterms[cterm] = 1
-            feature_terms[cfeature] = cterms
-            if len(cterms) == 0:
-                if foundna:
-                    feature_terms[cfeature] = ['na']
-        return feature_terms
+        if self._gnps_offsets is None:
+            raise ValueError('GNPS ids are not linked to the experiment features. Please call _prepare_gnps_ids() first.')
+        # results are memoized per term_type, so repeated queries only compute new features
+        cache = self._feature_terms_cache.setdefault(term_type, {})
+        missing = [cfeature for cfeature in features if cfeature not in cache]
+        if len(missing) > 0:
+            term_col = self._get_column(term_type)
+            term_isna = self._get_column_isna(term_type)
+            for cfeature in missing:
+                pos = self._feature_positions(cfeature)
+                na_mask = term_isna[pos]
+                # materialize the deduplicated terms in one C pass (keys become native python objects)
+                cterms = dict.fromkeys(term_col[pos][~na_mask].tolist(), 1)
+                if len(cterms) == 0:
+                    if na_mask.any():
+                        cterms = {'na': 1}
+                cache[cfeature] = cterms
+        # return copies so callers mutating their result don't corrupt the cache
+        return {cfeature: dict(cache[cfeature]) for cfeature in features}
@@ -52,7 +52,8 @@ setup(name='gnps-calour',
           'calour'],
       extras_require={'test': ["nose", "pep8", "flake8"],
                       'coverage': ["coverage"],
-                      'doc': ["Sphinx >= 1.4"]},
+                      'doc': ["Sphinx >= 1.4"],
+                      'numba': ["numba"]},
       entry_points={
           'console_scripts': [
               'calour=calour.cli:cmd',